@@ -1,23 +1,25 @@
 from contextlib import asynccontextmanager
+from typing import Any
 
 import psycopg
 from psycopg_pool import AsyncConnectionPool
 
-
-async def _configure(aconn: psycopg.AsyncConnection):
-    # NOTE: if not wrapped in a transaction, this will trigger psycopg's implicit transaction
-    async with aconn.transaction():
-        await aconn.execute("set search_path to emticketen")
+_connection_kwargs: dict[str, Any] = {
+    # applied by the server at connection startup, sparing a SET round-trip per connection
+    "options": "-c search_path=emticketen",
+    # prepare statements server side on their second execution instead of the sixth
+    # (psycopg prepares once a query has been executed prepare_threshold times, default 5)
+    "prepare_threshold": 1,
+}
 
 
 @asynccontextmanager
 async def async_connection():
-    async with await psycopg.AsyncConnection.connect() as aconn:
-        await _configure(aconn)
+    async with await psycopg.AsyncConnection.connect(**_connection_kwargs) as aconn:
         yield aconn
 
 
 @asynccontextmanager
 async def async_pool():
-    async with AsyncConnectionPool(configure=_configure, open=False) as apool:
+    async with AsyncConnectionPool(kwargs=_connection_kwargs, open=False) as apool:
         yield apool
@@ -1,13 +1,14 @@
-from typing import Any, Literal, LiteralString, Self
+from dataclasses import dataclass
+from typing import Any, ClassVar, Literal, LiteralString, Self
 
 import psycopg
 from psycopg.sql import SQL, Identifier, Placeholder
-from pydantic import BaseModel
 
 from .utils import ensure_row, get_row
 
 
-class Event(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Event:
     """
     create table events (
         id int primary key generated always as identity,
@@ -19,18 +20,36 @@ class Event(BaseModel):
     id: int
     slug: str
 
+    # events do not change once created, so lookups by slug can be cached in-process
+    # the cache is only read and written by get(…, cached=True), never by other methods
+    # NOTE: the cache knows nothing about the database, clear it when recreating tables
+    _cache: ClassVar[dict[str, Self]] = {}
+
     @classmethod
     async def ensure(cls, aconn: psycopg.AsyncConnection, slug: str) -> Self:
         id, slug = await ensure_row(aconn, "events", ("id", "slug"), slug=slug)
         return cls(id=id, slug=slug)
 
     @classmethod
-    async def get(cls, aconn: psycopg.AsyncConnection, slug: str) -> Self:
+    async def get(
+        cls, aconn: psycopg.AsyncConnection, slug: str, cached: bool = False
+    ) -> Self:
+        if cached and (event := cls._cache.get(slug)):
+            return event
+
         id, slug = await get_row(aconn, "events", slug=slug)
-        return cls(id=id, slug=slug)
+        event = cls(id=id, slug=slug)
+        if cached:
+            cls._cache[slug] = event
+        return event
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
 
 
-class Order(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Order:
     """
     create table orders (
         id int primary key generated always as identity,
@@ -48,6 +67,7 @@ class Order(BaseModel):
             await acur.execute(
                 "insert into orders (event_id) values (%s) returning id",
                 (event.id,),
+                prepare=True,
             )
             row = await acur.fetchone()
             if row is None:
@@ -56,7 +76,8 @@ class Order(BaseModel):
             return cls(id=id, event_id=event.id)
 
 
-class Product(BaseModel):
+@dataclass(slots=True, frozen=True)
+class Product:
     """
     create table products (
         id int primary key generated always as identity,
@@ -77,42 +98,78 @@ class Product(BaseModel):
     async def ensure(
         cls, aconn: psycopg.AsyncConnection, event: Event, slug: str, quota: int
     ) -> Self:
-        id, event_id, slug, quota = await ensure_row(
-            aconn,
-            "products",
-            returning=("id", "event_id", "slug", "quota"),
-            unique_fields=("event_id", "slug"),
-            event_id=event.id,
-            slug=slug,
-            quota=quota,
-        )
-
-        product = cls(id=id, event_id=event_id, slug=slug, quota=quota)
-
-        await product.ensure_tickets(aconn)
-
-        return product
-
-    async def ensure_tickets(self, aconn: psycopg.AsyncConnection):
         """
-        Ensure that the product has the correct number of tickets.
+        Ensure that the product exists and has the correct number of tickets.
         """
+        products = await cls.ensure_many(aconn, event, {slug: quota})
+        return products[slug]
 
+    @classmethod
+    async def ensure_many(
+        cls,
+        aconn: psycopg.AsyncConnection,
+        event: Event,
+        quotas: dict[str, int],
+    ) -> dict[str, Self]:
+        """
+        Ensure that the products exist and have the correct number of tickets.
+        Quotas are given as product slug -> quota. All products and their tickets
+        are created in a single statement.
+        """
         async with aconn.cursor() as acur:
             await acur.execute(
-                "select count(*) from tickets where product_id = %s", (self.id,)
-            )
-            count = row[0] if (row := await acur.fetchone()) else 0
-
-            if count == self.quota:
-                return
-            elif count > self.quota:
-                raise NotImplementedError("deleting tickets is not implemented")
-            else:
-                await acur.execute(
-                    "insert into tickets (product_id) select %s from generate_series(1, %s) as _",
-                    (self.id, self.quota - count),
+                # NOTE: the sub-statements of a WITH see the same snapshot,
+                # so the select from products only finds products that existed before,
+                # and num_tickets does not include tickets created by this statement
+                # DO NOTHING, as a dummy DO UPDATE would lock and rewrite existing products
+                """
+                with desired as (
+                    select %s::int as event_id, slug, quota
+                    from unnest(%s::text[], %s::int[]) as desired (slug, quota)
+                ),
+                inserted as (
+                    insert into products (event_id, slug, quota)
+                    select event_id, slug, quota
+                    from desired
+                    on conflict (event_id, slug) do nothing
+                    returning id, event_id, slug, quota
+                ),
+                ensured as (
+                    select id, event_id, slug, quota
+                    from inserted
+                    union all
+                    select products.id, products.event_id, products.slug, products.quota
+                    from products
+                    join desired using (event_id, slug)
+                ),
+                existing as (
+                    select ensured.id as product_id, count(tickets.id) as num_tickets
+                    from ensured
+                    left join tickets on tickets.product_id = ensured.id
+                    group by ensured.id
+                ),
+                created as (
+                    insert into tickets (product_id)
+                    select ensured.id
+                    from ensured
+                    join existing on existing.product_id = ensured.id
+                    cross join generate_series(1, ensured.quota - existing.num_tickets) as _
                 )
+                select ensured.id, event_id, slug, quota, num_tickets
+                from ensured
+                join existing on existing.product_id = ensured.id
+                """,
+                (event.id, list(quotas.keys()), list(quotas.values())),
+            )
+
+            products = {}
+            for id, event_id, slug, quota, num_tickets in await acur.fetchall():
+                if num_tickets > quota:
+                    raise NotImplementedError("deleting tickets is not implemented")
+
+                products[slug] = cls(id=id, event_id=event_id, slug=slug, quota=quota)
+
+            return products
 
     @classmethod
     async def get(cls, aconn: psycopg.AsyncConnection, event: Event, slug: str) -> Self:
@@ -132,26 +189,24 @@ class Product(BaseModel):
     ) -> list[tuple[Self, bool]]:
         async with aconn.cursor() as acur:
             await acur.execute(
-                # TODO can the correlated subquery be avoided?
-                # need to limit 1 per product, not altogether
-                # (then again, products is low cardinality, so it's not a big deal)
+                # NOTE: availability is advisory, so do not lock anything here;
+                # tickets locked by ongoing purchases still count as available
+                # thanks to tickets_free_idx, each EXISTS is a single index probe
                 """
                 select
                     id,
                     slug,
                     quota,
-                    (
-                        select id
+                    exists (
+                        select 1
                         from tickets
                         where product_id = products.id and order_id is null
-                        limit 1
-                        for update
-                        skip locked
-                    ) is not null as available
+                    ) as available
                 from products
                 where event_id = %s
                 """,
                 (event.id,),
+                prepare=True,
             )
 
             return [
@@ -164,7 +219,7 @@ class Product(BaseModel):
                     ),
                     available,
                 )
-                for (id, slug, quota, available) in await acur.fetchall()
+                async for (id, slug, quota, available) in acur
             ]
 
 
@@ -172,7 +227,29 @@ class NotEnoughTickets(RuntimeError):
     pass
 
 
-class Ticket(BaseModel):
+# Common start of the multi-product reservation statements.
+# Takes product ids and quantities as two arrays, and locks up to quantity free tickets
+# of each product in the reserved CTE.
+# NOTE: the planner cannot estimate the size of reserved (LIMIT varies per product)
+# so UPDATE … FROM reserved would hash the whole tickets table; = any(array(…)) uses the pkey
+_RESERVE_DESIRED_AMOUNTS = """
+    with reserved as (
+        select free_tickets.id
+        from unnest(%s::int[], %s::int[]) as desired (product_id, quantity)
+        cross join lateral (
+            select id
+            from tickets
+            where product_id = desired.product_id and order_id is null
+            limit desired.quantity
+            for update
+            skip locked
+        ) as free_tickets
+    )
+"""
+
+
+@dataclass(slots=True, frozen=True)
+class Ticket:
     """
     create table tickets (
         id int primary key generated always as identity,
@@ -182,6 +259,8 @@ class Ticket(BaseModel):
         foreign key (order_id) references orders (id)
     );
 
+    create index tickets_free_idx on tickets (product_id) where order_id is null;
+
     comment on table tickets is 'A "ticket" is an instance of a product. All salable instances of a product must be realized as tickets.';
     """
 
@@ -196,7 +275,29 @@ class Ticket(BaseModel):
         order: Order,
         product: Product,
         quantity: int,
-    ):
+    ) -> list[Self]:
+        ids = await cls.reserve_ids(aconn, order, product, quantity)
+        return [
+            cls(
+                id=id,
+                product_id=product.id,
+                order_id=order.id,
+            )
+            for id in ids
+        ]
+
+    @classmethod
+    async def reserve_ids(
+        cls,
+        aconn: psycopg.AsyncConnection,
+        order: Order,
+        product: Product,
+        quantity: int,
+    ) -> list[int]:
+        """
+        Like reserve, but only returns the ids of the reserved tickets,
+        sparing the construction of models the caller would throw away.
+        """
         async with aconn.cursor() as acur:
             await acur.execute(
                 """
@@ -215,21 +316,115 @@ class Ticket(BaseModel):
                 returning tickets.id
                 """,
                 (product.id, quantity, order.id),
+                prepare=True,
             )
 
-            rows = await acur.fetchall()
+            ids = [id async for (id,) in acur]
 
-            if len(rows) < quantity:
+            if len(ids) < quantity:
                 raise NotEnoughTickets()
 
-            return [
-                cls(
-                    id=id,
-                    product_id=product.id,
-                    order_id=order.id,
+            return ids
+
+    @classmethod
+    async def reserve_many(
+        cls,
+        aconn: psycopg.AsyncConnection,
+        order: Order,
+        desired_amounts: dict[Product, int],
+    ) -> list[int]:
+        """
+        Reserve tickets of multiple products of the order's event in a single statement.
+        Desired amounts are given as product -> quantity.
+        Returns the ids of the reserved tickets.
+        """
+        if any(product.event_id != order.event_id for product in desired_amounts):
+            raise ValueError("cannot reserve tickets of another event's products")
+
+        async with aconn.cursor() as acur:
+            await acur.execute(
+                _RESERVE_DESIRED_AMOUNTS
+                + """
+                update tickets
+                set order_id = %s
+                where id = any(array(select id from reserved))
+                returning id
+                """,
+                (
+                    [product.id for product in desired_amounts],
+                    list(desired_amounts.values()),
+                    order.id,
+                ),
+                prepare=True,
+            )
+
+            ids = [id async for (id,) in acur]
+
+            # each product is limited to its desired quantity,
+            # so any shortfall shows in the total
+            if len(ids) < sum(desired_amounts.values()):
+                raise NotEnoughTickets()
+
+            return ids
+
+    @classmethod
+    async def reserve_with_new_order(
+        cls,
+        aconn: psycopg.AsyncConnection,
+        event: Event,
+        desired_amounts: dict[Product, int],
+    ) -> tuple[Order, list[int]]:
+        """
+        Create an order and reserve tickets for it in a single statement.
+        Like reserve_many, desired amounts are given as product -> quantity.
+        Returns the order and the ids of the reserved tickets.
+        """
+        if any(product.event_id != event.id for product in desired_amounts):
+            raise ValueError("cannot reserve tickets of another event's products")
+
+        async with aconn.cursor() as acur:
+            await acur.execute(
+                # NOTE: the order is returned even if no tickets were reserved
+                _RESERVE_DESIRED_AMOUNTS
+                + """,
+                new_order as (
+                    insert into orders (event_id)
+                    values (%s)
+                    returning id
+                ),
+                updated as (
+                    update tickets
+                    set order_id = (select id from new_order)
+                    where id = any(array(select id from reserved))
+                    returning id
                 )
-                for (id,) in rows
-            ]
+                select new_order.id, updated.id
+                from new_order
+                left join updated on true
+                """,
+                (
+                    [product.id for product in desired_amounts],
+                    list(desired_amounts.values()),
+                    event.id,
+                ),
+                prepare=True,
+            )
+
+            order_id = None
+            ticket_ids = []
+            async for order_id, ticket_id in acur:
+                if ticket_id is not None:
+                    ticket_ids.append(ticket_id)
+
+            if order_id is None:
+                raise AssertionError("INSERT RETURNING returned nothing")
+
+            order = Order(id=order_id, event_id=event.id)
+
+            if len(ticket_ids) < sum(desired_amounts.values()):
+                raise NotEnoughTickets()
+
+            return order, ticket_ids
 
     @classmethod
     async def count_free(
@@ -241,18 +436,39 @@ class Ticket(BaseModel):
             await acur.execute(
                 "select count(*) from tickets where product_id = %s and order_id is null",
                 (product.id,),
+                prepare=True,
             )
             row = await acur.fetchone()
             return row[0] if row else 0
 
+    @classmethod
+    async def has_free(
+        cls,
+        aconn: psycopg.AsyncConnection,
+        product: Product,
+    ) -> bool:
+        """
+        Cheaper than count_free when only the existence of a free ticket matters.
+        """
+        async with aconn.cursor() as acur:
+            await acur.execute(
+                "select exists (select 1 from tickets where product_id = %s and order_id is null)",
+                (product.id,),
+                prepare=True,
+            )
+            row = await acur.fetchone()
+            return row[0] if row else False
+
 
 async def create_tables(aconn: psycopg.AsyncConnection):
     """
     Create tables, extracting SQL from dataclass docstrings.
     """
+    # without parameters, psycopg sends all statements in a single round-trip
+    ddl = "\n".join(cls.__doc__ or "" for cls in (Event, Product, Order, Ticket))
+
     async with aconn.cursor() as acur:
-        for cls in (Event, Product, Order, Ticket):
-            # psycopg typings protect us from SQL injection
-            # however, we know that cls.__doc__ is a literal string written by us
-            await acur.execute(cls.__doc__)  # type: ignore
+        # psycopg typings protect us from SQL injection
+        # however, we know that the docstrings are literal strings written by us
+        await acur.execute(ddl)  # type: ignore
         await aconn.commit()
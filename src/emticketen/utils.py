@@ -1,11 +1,53 @@
+from functools import lru_cache
 from typing import Any, Literal, LiteralString
 
 import psycopg
-from psycopg.sql import SQL, Identifier, Placeholder
+from psycopg.sql import SQL, Composed, Identifier, Placeholder
 
 TableName = Literal["events", "products", "orders", "tickets"]
 
 
+@lru_cache(maxsize=256)
+def _build_insert_sql(
+    table_name: TableName,
+    keys: tuple[str, ...],
+    returning: tuple[LiteralString, ...],
+    unique_fields: tuple[LiteralString, ...],
+) -> Composed:
+    # NOTE: ON CONFLICT DO NOTHING RETURNING only returns created rows, not existing ones
+    # so fall back to selecting the existing row in the same statement, sparing a round-trip
+    # (a dummy DO UPDATE would return it, too, but lock and rewrite it)
+    # the sub-statements of a WITH see the same snapshot, so at most one branch returns a row
+    return SQL("""
+        with inserted as (
+            insert into {table_name} ({fields})
+            values ({value_placeholders})
+            on conflict ({unique_fields}) do nothing
+            returning {returning}
+        )
+        select {returning}
+        from inserted
+        union all
+        select {returning}
+        from {table_name}
+        where {where}
+        limit 1
+    """).format(
+        table_name=Identifier(table_name),
+        fields=SQL(", ").join(Identifier(key) for key in keys),
+        value_placeholders=SQL(", ").join(Placeholder(key) for key in keys),
+        returning=SQL(", ").join(Identifier(col) for col in returning),
+        unique_fields=SQL(", ").join(Identifier(col) for col in unique_fields),
+        where=SQL(" and ").join(
+            SQL("{field_name} = {field_value}").format(
+                field_name=Identifier(col),
+                field_value=Placeholder(col),
+            )
+            for col in unique_fields
+        ),
+    )
+
+
 async def ensure_row(
     aconn: psycopg.AsyncConnection,
     table_name: TableName,
@@ -16,43 +58,16 @@ async def ensure_row(
     """
     Ensure that a row exists in a table.
     """
-    insert_sql = SQL("""
-        insert into {table_name} ({fields})
-        values ({value_placeholders})
-        on conflict ({unique_fields}) do nothing
-        returning ({returning})
-    """).format(
-        table_name=Identifier(table_name),
-        fields=SQL(", ").join(Identifier(key) for key in kwargs),
-        value_placeholders=SQL(", ").join(Placeholder() for _ in kwargs),
-        returning=SQL(", ").join(Identifier(col) for col in returning),
-        unique_fields=SQL(", ").join(Identifier(col) for col in unique_fields),
-    )
+    insert_sql = _build_insert_sql(table_name, tuple(kwargs), returning, unique_fields)
 
     async with aconn.cursor() as acur:
-        await acur.execute(insert_sql, tuple(kwargs.values()))
+        await acur.execute(insert_sql, kwargs)
 
         row = await acur.fetchone()
 
-        if row is not None:
-            # inserted
-            # NOTE: unintuitive behaviour of psycopg/postgres:
-            # if there is only one field in RETURNING, each row has one scalar field
-            # if there are more than one fields, each row has one tuple field containing all RETURNING fields
-            return row[0] if len(returning) > 1 else row
-
-        # already exists
-        # RETURNING only returns created row, not the existing one
-        # so need to do an explicit SELECT
-        row = await get_row(
-            aconn, table_name, *{key: kwargs[key] for key in unique_fields}
-        )
-
         if row is None:
             raise AssertionError(
-                "INSERT ON CONFLICT (…) DO NOTHING RETURNING (…) returned nothing, "
-                "implying that the row already existed; "
-                "but SELECT returned nothing too"
+                "INSERT ON CONFLICT (…) DO NOTHING RETURNING (…) UNION ALL SELECT returned nothing"
             )
 
         return row
@@ -62,15 +77,9 @@ class MultipleRowsReturned(RuntimeError):
     pass
 
 
-async def get_row(
-    aconn: psycopg.AsyncConnection,
-    table_name: TableName,
-    **kwargs,
-) -> tuple[Any, ...]:
-    """
-    Get a single row from a table.
-    """
-    select_sql = SQL("""
+@lru_cache(maxsize=256)
+def _build_select_sql(table_name: TableName, keys: tuple[str, ...]) -> Composed:
+    return SQL("""
         select *
         from {table_name}
         where {where}
@@ -82,19 +91,30 @@ async def get_row(
                 field_name=Identifier(key),
                 field_value=Placeholder(),
             )
-            for key in kwargs
+            for key in keys
         ),
     )
 
+
+async def get_row(
+    aconn: psycopg.AsyncConnection,
+    table_name: TableName,
+    **kwargs,
+) -> tuple[Any, ...]:
+    """
+    Get a single row from a table.
+    """
+    select_sql = _build_select_sql(table_name, tuple(kwargs))
+
     async with aconn.cursor() as acur:
         await acur.execute(select_sql, tuple(kwargs.values()))
 
-        if acur.rowcount > 1:
-            raise MultipleRowsReturned((kwargs, acur.rowcount))
+        rows = await acur.fetchmany(2)
 
-        row = await acur.fetchone()
+        if len(rows) > 1:
+            raise MultipleRowsReturned((kwargs, len(rows)))
 
-        if row is None:
+        if not rows:
             raise KeyError(kwargs)
 
-        return row
+        return rows[0]
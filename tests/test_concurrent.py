@@ -8,10 +8,12 @@ async def test_concurrent(apool: AsyncConnectionPool):
         event = await Event.ensure(aconn, "test-event")
         product = await Product.ensure(aconn, event, "test-product", 10)
 
-    async with apool.connection() as aconn1, apool.connection() as aconn2:
-        await aconn1.execute("begin")
-        await aconn2.execute("begin")
-
+    async with (
+        apool.connection() as aconn1,
+        apool.connection() as aconn2,
+        aconn1.transaction(),
+        aconn2.transaction(force_rollback=True),
+    ):
         order1 = await Order.create(aconn1, event)
         order2 = await Order.create(aconn2, event)
 
@@ -20,6 +22,3 @@ async def test_concurrent(apool: AsyncConnectionPool):
         # magic! aconn1 still holding transaction open
         with pytest.raises(NotEnoughTickets):
             await Ticket.reserve(aconn2, order2, product, 7)
-
-        await aconn1.execute("commit")
-        await aconn2.execute("rollback")
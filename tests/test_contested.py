@@ -3,7 +3,8 @@ from collections import Counter
 from enum import Enum, auto
 from random import choice, uniform
 
-from emticketen.models import Event, NotEnoughTickets, Order, Product, Ticket
+from emticketen.models import Event, NotEnoughTickets, Product, Ticket
+from psycopg.errors import LockNotAvailable, QueryCanceled
 from psycopg_pool import AsyncConnectionPool
 
 
@@ -12,7 +13,7 @@ async def _view_products_page(apool: AsyncConnectionPool):
     Simulates a buyer viewing the web shop page that tells if the product is available or not.
     """
     async with apool.connection() as aconn:
-        event = await Event.get(aconn, "test-event")
+        event = await Event.get(aconn, "test-event", cached=True)
         result = await Product.get_products_with_availability(aconn, event)
 
         await asyncio.sleep(uniform(0, 0.001))
@@ -20,17 +21,31 @@ async def _view_products_page(apool: AsyncConnectionPool):
         return result
 
 
-async def _buy_tickets(apool: AsyncConnectionPool, desired_amounts: dict[str, int]):
+async def _buy_tickets(
+    apool: AsyncConnectionPool,
+    products: dict[str, Product],
+    desired_amounts: dict[str, int],
+):
     """
     Simulates a buyer buying tickets.
     """
     async with apool.connection() as aconn:
-        event = await Event.get(aconn, "test-event")
-        order = await Order.create(aconn, event)
-
-        for product_slug, quantity in desired_amounts.items():
-            product = await Product.get(aconn, event, product_slug)
-            await Ticket.reserve(aconn, order, product, quantity)
+        event = await Event.get(aconn, "test-event", cached=True)
+
+        # bound how long a contended buyer can hold on to a connection
+        # NOTE: set local only lasts until the end of this buyer's transaction,
+        # and the pipeline sends it along with the reservation in one round-trip
+        async with aconn.pipeline():
+            await aconn.execute("set local lock_timeout = '250ms'")
+            await aconn.execute("set local statement_timeout = '2s'")
+            await Ticket.reserve_with_new_order(
+                aconn,
+                event,
+                {
+                    products[slug]: quantity
+                    for slug, quantity in desired_amounts.items()
+                },
+            )
 
         await asyncio.sleep(uniform(0, 0.001))
 
@@ -54,12 +69,16 @@ class Result(Enum):
 
 async def _buyer(
     apool: AsyncConnectionPool,
+    semaphore: asyncio.Semaphore,
+    products: dict[str, Product],
     max_tardiness_seconds: int = 10,
     max_time_to_buy_seconds: int = 5,
 ):
     await asyncio.sleep(uniform(0, max_tardiness_seconds))
 
-    availability = await _view_products_page(apool)
+    # NOTE: semaphore is held only while talking to the database, not while idling
+    async with semaphore:
+        availability = await _view_products_page(apool)
     if not any(available for _, available in availability):
         return Result.SERVED_SOLD_OUT_PAGE
 
@@ -76,8 +95,10 @@ async def _buyer(
         return Result.JUST_BROWSING
 
     try:
-        await _buy_tickets(apool, desired_amounts)
-    except NotEnoughTickets:
+        async with semaphore:
+            await _buy_tickets(apool, products, desired_amounts)
+    except (NotEnoughTickets, LockNotAvailable, QueryCanceled):
+        # NOTE: hitting lock_timeout or statement_timeout counts as losing the race
         return Result.NOT_ENOUGH_TICKETS
     else:
         return Result.SUCCESS
@@ -91,13 +112,21 @@ async def test_contested(
 ):
     async with apool.connection() as aconn:
         event = await Event.ensure(aconn, "test-event")
-        for i in range(num_products):
-            await Product.ensure(
-                aconn, event, f"test-product-{i}", num_tickets_per_product
-            )
-
-    buyers = [_buyer(apool) for _ in range(num_buyers)]
-    results = Counter(await asyncio.gather(*buyers))
+        # products do not change during the test, so buyers need not look them up
+        products = await Product.ensure_many(
+            aconn,
+            event,
+            {f"test-product-{i}": num_tickets_per_product for i in range(num_products)},
+        )
+
+    # limit the number of buyers contending for the pool at once
+    semaphore = asyncio.Semaphore(apool.max_size)
+    async with asyncio.TaskGroup() as tg:
+        buyers = [
+            tg.create_task(_buyer(apool, semaphore, products))
+            for _ in range(num_buyers)
+        ]
+    results = Counter(buyer.result() for buyer in buyers)
     print(results)
 
     async with apool.connection() as aconn, aconn.cursor() as acur:
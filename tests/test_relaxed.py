@@ -22,6 +22,7 @@ async def test_relaxed(aconn: psycopg.AsyncConnection):
 
     num_free_tickets = await Ticket.count_free(aconn, product)
     assert num_free_tickets == 1
+    assert await Ticket.has_free(aconn, product)
 
     availability = await Product.get_products_with_availability(aconn, event)
     product, available = availability[0]
@@ -29,8 +30,119 @@ async def test_relaxed(aconn: psycopg.AsyncConnection):
     assert available
 
     await Ticket.reserve(aconn, order, product, 1)
+    assert not await Ticket.has_free(aconn, product)
 
     availability = await Product.get_products_with_availability(aconn, event)
     product, available = availability[0]
     assert product.slug == "test-product"
     assert not available
+
+
+async def test_ensure_existing_event(aconn: psycopg.AsyncConnection):
+    """
+    Ensuring an existing row returns it instead of inserting a new one.
+    """
+    event1 = await Event.ensure(aconn, "test-event")
+    event2 = await Event.ensure(aconn, "test-event")
+    assert event2.id == event1.id
+
+
+async def test_event_cache(aconn: psycopg.AsyncConnection):
+    """
+    Only cached gets use the event cache, and clearing it empties it.
+    """
+    Event.clear_cache()
+    event = await Event.ensure(aconn, "test-event")
+
+    assert await Event.get(aconn, "test-event") == event
+    assert not Event._cache
+
+    cached_event = await Event.get(aconn, "test-event", cached=True)
+    assert await Event.get(aconn, "test-event", cached=True) is cached_event
+
+    Event.clear_cache()
+    assert not Event._cache
+
+
+async def test_ensure_existing_products(aconn: psycopg.AsyncConnection):
+    """
+    Ensuring existing products does not create duplicate tickets.
+    """
+    event = await Event.ensure(aconn, "test-event")
+    product = await Product.ensure(aconn, event, "test-product", 10)
+    assert await Product.ensure(aconn, event, "test-product", 10) == product
+
+    products = await Product.ensure_many(
+        aconn, event, {"test-product": 10, "other-product": 5}
+    )
+    assert products["test-product"] == product
+    assert await Ticket.count_free(aconn, products["test-product"]) == 10
+    assert await Ticket.count_free(aconn, products["other-product"]) == 5
+
+
+async def test_reserve_many(aconn: psycopg.AsyncConnection):
+    """
+    Reserving several products at once is all or nothing.
+    """
+    event = await Event.ensure(aconn, "test-event")
+    product = await Product.ensure(aconn, event, "test-product", 10)
+    other_product = await Product.ensure(aconn, event, "other-product", 2)
+    order = await Order.create(aconn, event)
+
+    ticket_ids = await Ticket.reserve_many(aconn, order, {product: 3, other_product: 1})
+    assert len(ticket_ids) == 4
+
+    with pytest.raises(NotEnoughTickets):
+        async with aconn.transaction():
+            await Ticket.reserve_many(aconn, order, {product: 3, other_product: 2})
+
+    # the partial reservation was rolled back
+    assert await Ticket.count_free(aconn, product) == 7
+    assert await Ticket.count_free(aconn, other_product) == 1
+
+    other_event = await Event.ensure(aconn, "other-event")
+    other_event_product = await Product.ensure(aconn, other_event, "test-product", 1)
+    with pytest.raises(ValueError):
+        await Ticket.reserve_many(aconn, order, {other_event_product: 1})
+
+
+async def test_reserve_with_new_order(aconn: psycopg.AsyncConnection):
+    """
+    Reserving with a new order creates the order and its tickets together.
+    """
+    event = await Event.ensure(aconn, "test-event")
+    product = await Product.ensure(aconn, event, "test-product", 10)
+    other_product = await Product.ensure(aconn, event, "other-product", 2)
+
+    order, ticket_ids = await Ticket.reserve_with_new_order(
+        aconn, event, {product: 3, other_product: 1}
+    )
+    assert order.event_id == event.id
+    assert len(ticket_ids) == 4
+
+    async with aconn.cursor() as acur:
+        await acur.execute("select id from tickets where order_id = %s", (order.id,))
+        assert sorted(id for (id,) in await acur.fetchall()) == sorted(ticket_ids)
+
+    # the order is returned even if no tickets were reserved
+    empty_order, ticket_ids = await Ticket.reserve_with_new_order(aconn, event, {})
+    assert empty_order.id != order.id
+    assert ticket_ids == []
+
+    with pytest.raises(NotEnoughTickets):
+        async with aconn.transaction():
+            await Ticket.reserve_with_new_order(
+                aconn, event, {product: 3, other_product: 2}
+            )
+
+    # the partial reservation and its order were rolled back
+    assert await Ticket.count_free(aconn, product) == 7
+    assert await Ticket.count_free(aconn, other_product) == 1
+    async with aconn.cursor() as acur:
+        await acur.execute("select count(*) from orders")
+        assert await acur.fetchone() == (2,)
+
+    other_event = await Event.ensure(aconn, "other-event")
+    other_event_product = await Product.ensure(aconn, other_event, "test-product", 1)
+    with pytest.raises(ValueError):
+        await Ticket.reserve_with_new_order(aconn, event, {other_event_product: 1})